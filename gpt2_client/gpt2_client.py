@@ -3,11 +3,19 @@
 import os
 from termcolor import colored, cprint
 import requests
+from requests.adapters import HTTPAdapter
 import sys
+import glob
+import queue
+import threading
+import multiprocessing
 from tqdm import tqdm
 import json
 import json
+import heapq
 import regex as re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import tensorflow as tf
 from tensorflow.contrib.training import HParams
@@ -19,9 +27,14 @@ try:
 except ImportError:
     from backports.functools_lru_cache import lru_cache
 
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
 
 class GPT2Client(object):
-    def __init__(self, model_name='124M', save_dir='models'):
+    def __init__(self, model_name='124M', save_dir='models', dtype='fp32', use_xla=False, num_intra=None, num_inter=2):
         """
         Attributes
         ----------
@@ -34,35 +47,82 @@ class GPT2Client(object):
         - desc: Name of directory where the weights, checkpoints, and 
                 hyper-parameters are downloaded and saved
 
+        attr: dtype (string)
+        - default: 'fp32'
+        - desc: Precision of the weight matrices used while sampling. 'fp16' halves the memory
+                read per generated token. Layer norm and softmax always run in float32
+
+        attr: use_xla (bool)
+        - default: False
+        - desc: JIT-compiles the sampling graph with XLA, fusing the many small ops of every
+                transformer block into fewer kernels. Requires a TensorFlow build with XLA.
+                TensorFlow only auto-clusters GPU ops; on CPU it has no effect unless the process
+                starts with TF_XLA_FLAGS=--tf_xla_cpu_global_jit set in its environment
+
+        attr: num_intra (int)
+        - default: None
+        - desc: Number of threads a single op, such as a matmul, may use. Defaults to the number of CPUs
+                this process is allowed to run on
+
+        attr: num_inter (int)
+        - default: 2
+        - desc: Number of independent ops TensorFlow runs concurrently
+
         Methods
         -------
         download_helper(filename : string)
         load_model(force_download : bool)
-        generate(interactive : bool, n_samples : int, words : int, display : bool, return_text: bool) -> list of string
-        generate_batch_from_prompts(prompts : list) -> list of string
+        generate(interactive : bool, n_samples : int, words : int, display : bool, return_text: bool, batch_size : int) -> list of string
+        generate_batch_from_prompts(prompts : list, words : int, batch_size : int, n_workers : int) -> list of string
         fintune(corpus : object, return_text : bool) -> text
         encode_seq(sequence : string) -> numpy array of integer
         decode_seq(sequence : integers) -> list of string
+        close()
         """
 
         assert model_name in ['124M', '355M', '774M',
                               '1558M'], 'Please choose from either 124M, 355M, 774M, or 1558M parameter models only. This library does support other model sizes.'
         assert save_dir != '', 'Please provide a save directory for the model weights and checkpoints. This cannot be empty.'
+        assert dtype in ['fp32', 'fp16'], 'Please choose either fp32 or fp16 as the sampling precision.'
 
         self.model_name = model_name
         self.save_dir = save_dir
+        self.dtype = dtype
+        self.use_xla = use_xla
+        self.num_intra = num_intra if num_intra is not None else len(_usable_cpus())
+        self.num_inter = num_inter
+
+        # Keep-alive session shared by all downloads, so the files reuse one TLS connection.
+        # Opened on the first download and closed by `close`
+        self._http = None
+
+        # Sampling graph and session, built lazily by `_ensure_session`
+        self._sess = None
+        self._hparams = None
+        self._iterator = None
+        self._batch_size_ph = None
+        self._length_ph = None
+        self._output = None
+        self._pending_contexts = []
+        self._decode_pool = None
+        # Guards the session build and the shared input iterator, see `_sample`
+        self._session_lock = threading.Lock()
 
     def download_helper(self, filename):
-        r = requests.get('https://openaipublic.blob.core.windows.net/gpt-2/models/' +
-                         self.model_name + '/' + filename, stream=True)
+        if self._http is None:
+            self._http = requests.Session()
+            self._http.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
+        r = self._http.get('https://openaipublic.blob.core.windows.net/gpt-2/models/' +
+                           self.model_name + '/' + filename, stream=True)
 
         with open("./{}/{}/{}".format(self.save_dir, self.model_name, filename), 'wb') as f:
             file_size = int(r.headers['content-length'])
-            chunk_size = 1000
+            chunk_size = 1 << 20
             with tqdm(ncols=100, desc='Downloading {}'.format(colored(filename, 'cyan', attrs=['bold'])), total=file_size, unit_scale=True) as pbar:
                 for chunk in r.iter_content(chunk_size=chunk_size):
                     f.write(chunk)
-                    pbar.update(chunk_size)
+                    pbar.update(len(chunk))
 
     def load_model(self, force_download=False):
         """ Creates `models` directory and downloads model weights and checkpoints
@@ -91,7 +151,7 @@ class GPT2Client(object):
                 else:
                     self.download_helper(filename)
 
-    def generate(self, interactive=False, n_samples=1, words=None, display=True, return_text=False):
+    def generate(self, interactive=False, n_samples=1, words=None, display=True, return_text=False, batch_size=None):
         """ Returns generated text sample
 
         Parameters
@@ -101,12 +161,14 @@ class GPT2Client(object):
             - desc: Toggles interactive mode which prompts user for input text
 
         arg: n_samples (int)
-            - default: 0
-            - desc: Number of samples to be generated by GPT-2 Model. If 0, it generates indefinitely
+            - default: 1
+            - desc: Number of samples to be generated by GPT-2 Model, drawn together in runs of up to `batch_size`.
+                    In interactive mode, this is both the number of prompts and the samples per prompt.
+                    If 0, it generates indefinitely
 
         arg: words (int)
             - default=None
-            - desc: Number of words generated by the client
+            - desc: Number of words generated by the client. Falls back to half of the model's context size
 
         arg: display (bool)
             - default: True
@@ -116,162 +178,193 @@ class GPT2Client(object):
             - default: False
             - desc: Returns generated text when set to True
 
+        arg: batch_size (int)
+            - default=None
+            - desc: Maximum number of samples drawn per run. All samples are drawn at once when set to None
+
         Returns:
             An array of generated strings
         """
 
-        models_dir = models_dir = os.path.expanduser(
-            os.path.expandvars(self.save_dir))
         enc = get_encoder(self.model_name, self.save_dir)
-        hparams = default_hparams()
-
-        with open(os.path.join(self.save_dir, self.model_name, 'hparams.json')) as f:
-            data = json.load(f)
-            hparams.override_from_dict(data)
-
-        length = hparams.n_ctx
-
-        with tf.Session(graph=tf.Graph()) as sess:
-            batch_size = 1
-            temperature = 1
-            top_k = 40
+        end_token = enc.encoder['<|endoftext|>']
+
+        if words is None:
+            words = self._load_hparams().n_ctx // 2
+
+        # One sample per run when generating indefinitely
+        n_rows = n_samples or 1
+        if batch_size is None:
+            batch_size = n_rows
+
+        if not interactive:
+            # Generate random samples from scratch
+            print(colored('Generating sample...', 'yellow'))
+
+            text = []
+            while True:
+                with self._session_lock:
+                    self._ensure_session()
+                    outputs = list(self._sample(
+                        [[end_token] for _ in range(n_rows)], words, batch_size))
+
+                for out in outputs:
+                    for tokens in out:
+                        text.append(enc.decode(tokens))
+                        print(
+                            colored('---------------------SAMPLE---------------------\n', 'cyan'))
 
-            context = tf.placeholder(tf.int32, [batch_size, None])
-            np.random.seed(None)
-            tf.set_random_seed(None)
+                        if display:
+                            print(text[-1])
 
-            output = sample_sequence(
-                hparams=hparams,
-                length=words,
-                start_token=enc.encoder['<|endoftext|>'],
-                batch_size=batch_size,
-                temperature=temperature,
-                top_k=top_k
-            )
+                if n_samples != 0:
+                    break
 
-            saver = tf.train.Saver()
-            ckpt = tf.train.latest_checkpoint(
-                os.path.join(self.save_dir, self.model_name))
-            saver.restore(sess, ckpt)
+            if return_text:
+                return text
 
-            if not interactive:
-                # Generate random samples from scratch
+        else:
+            # Generate random samples from prompt
+            text_array = []
+            for _ in range(n_samples):
+                prompt = input(
+                    colored('Enter a prompt got GPT-2 >> ', 'cyan'))
+                print('{}: {}\n'.format(
+                    colored('Prompt', attrs=['bold']), colored(prompt, 'green')))
                 print(colored('Generating sample...', 'yellow'))
 
-                # must initialize generated...
-                generated = 0
-                text = []
-                while n_samples == 0 or generated < n_samples:
-                    out = sess.run(output)
-                    for i in range(batch_size):
-                        generated += batch_size
-                        text.append(enc.decode(out[i]))
+                context_tokens = enc.encode(prompt) or [end_token]
+                with self._session_lock:
+                    self._ensure_session()
+                    outputs = list(self._sample(
+                        [context_tokens for _ in range(n_rows)], words, batch_size))
+
+                for out in outputs:
+                    for tokens in out:
+                        text_array.append(enc.decode(tokens))
                         print(
                             colored('---------------------SAMPLE---------------------\n', 'cyan'))
 
                         if display:
-                            print(text)
+                            print(text_array[-1])
 
-                        if return_text:
-                            return text
+            if return_text:
+                return text_array
 
-            else:
-                # Generate random samples from prompt
-                for _ in range(n_samples):
-                    prompt = input(
-                        colored('Enter a prompt got GPT-2 >> ', 'cyan'))
-                    print('{}: {}\n'.format(
-                        colored('Prompt', attrs=['bold']), colored(prompt, 'green')))
-                    print(colored('Generating sample...', 'yellow'))
-
-                    context_tokens = enc.encode(prompt)
-                    text_array = []
-                    text = ''
-                    generated = 0
-                    for _ in range(n_samples // batch_size):
-                        out = sess.run(output, feed_dict={
-                            context: [
-                                context_tokens for _ in range(batch_size)]
-                        })[:, len(context_tokens):]
-
-                        for i in range(batch_size):
-                            generated += 1
-                            text += enc.decode(out[i])
-                            text_array.append(enc.decode(out[i]))
-                            print(
-                                colored('---------------------SAMPLE---------------------\n', 'cyan'))
-
-                            if display:
-                                print(text)
-
-                            if return_text:
-                                return text_array
-
-    def generate_batch_from_prompts(self, batch, words=None):
+    def generate_batch_from_prompts(self, batch, words=None, batch_size=None, n_workers=1):
         """ Returns an array of generated text
 
         Parameters
         ----------
         arg: batch (list)
             - desc: An array of prompts given to the GPT2Client instance.
-                    The contents of the array are fed to the instance one by one
-
-        Returns:
-            An array of generated text for each prompt given in `batch`
-        """
+                    The prompts are left-padded and sampled together in a single run
 
-        final_generated_text = []
-
-        models_dir = models_dir = os.path.expanduser(
-            os.path.expandvars(self.save_dir))
-        enc = get_encoder(self.model_name, self.save_dir)
-        hparams = default_hparams()
-
-        with open(os.path.join(self.save_dir, self.model_name, 'hparams.json')) as f:
-            data = json.load(f)
-            hparams.override_from_dict(data)
-
-        length = hparams.n_ctx
-
-        with tf.Session(graph=tf.Graph()) as sess:
-            batch_size = 1
-            temperature = 1
-            top_k = 40
+        arg: words (int)
+            - default=None
+            - desc: Number of words generated for each prompt. Falls back to half of the model's context size
 
-            context = tf.placeholder(tf.int32, [batch_size, None])
-            np.random.seed(None)
-            tf.set_random_seed(None)
+        arg: batch_size (int)
+            - default=None
+            - desc: Maximum number of prompts sampled per run. All prompts are sampled at once when set to None
 
-            output = sample_sequence(
-                hparams=hparams,
-                length=words,
-                start_token=enc.encoder['<|endoftext|>'],
-                batch_size=batch_size,
-                temperature=temperature,
-                top_k=top_k
-            )
+        arg: n_workers (int)
+            - default: 1
+            - desc: Number of processes sampling in parallel on CPU. Each process loads its own copy of the model
+                    and is pinned to its own set of cores, one NUMA node per process where possible.
+                    Scripts using more than one worker need an `if __name__ == '__main__':` guard
 
-            saver = tf.train.Saver()
-            ckpt = tf.train.latest_checkpoint(
-                os.path.join(self.save_dir, self.model_name))
-            saver.restore(sess, ckpt)
+        Returns:
+            An array of generated text for each prompt given in `batch`, in the same order
+        """
 
-            for i in batch:
-                print('Prompt: {}'.format(colored(i, 'green')))
-                context_tokens = enc.encode(i)
-                text_array = []
-                text = ''
-                generated = 0
-                for _ in range(len(batch) // batch_size):
-                    out = sess.run(output, feed_dict={
-                        context: [context_tokens for _ in range(batch_size)]
-                    })[:, len(context_tokens):]
+        if n_workers > 1 and len(batch) > 1:
+            return self._generate_batch_in_workers(batch, words, batch_size, n_workers)
 
-                    for i in range(batch_size):
-                        generated += 1
-                        text += enc.decode(out[i])
+        enc = get_encoder(self.model_name, self.save_dir)
+        end_token = enc.encoder['<|endoftext|>']
+
+        if words is None:
+            words = self._load_hparams().n_ctx // 2
+        if batch_size is None:
+            batch_size = max(len(batch), 1)
+
+        context_tokens = []
+        for prompt in batch:
+            print('Prompt: {}'.format(colored(prompt, 'green')))
+            context_tokens.append(enc.encode(prompt) or [end_token])
+
+        # Longest prompts first, so every run pads its rows to a similar length
+        order = sorted(range(len(batch)),
+                       key=lambda i: len(context_tokens[i]), reverse=True)
+
+        # With several runs, decoding moves to a background thread while the next batch
+        # is being sampled. A single run has nothing to overlap with, so it decodes inline
+        overlap = len(order) > batch_size
+        decoded = {}
+        with self._session_lock:
+            self._ensure_session()
+            decode_pool = self._decode_pool
+            outputs = self._sample(
+                [context_tokens[i] for i in order], words, batch_size)
+            for run, out in enumerate(outputs):
+                start = run * batch_size
+                for i, tokens in zip(order[start:start + batch_size], out):
+                    if overlap:
+                        decoded[i] = decode_pool.submit(enc.decode, tokens)
+                    else:
+                        decoded[i] = enc.decode(tokens)
+
+        final_generated_text = [decoded[i].result() if overlap else decoded[i]
+                                for i in range(len(batch))]
+        return final_generated_text
 
-                        final_generated_text.append(enc.decode(out[i]))
+    def _generate_batch_in_workers(self, batch, words, batch_size, n_workers):
+        """ Spreads `batch` over worker processes that pull chunks of prompts from a shared queue """
+        enc = get_encoder(self.model_name, self.save_dir)
+        order = sorted(range(len(batch)),
+                       key=lambda i: len(enc.encode(batch[i])), reverse=True)
+        if batch_size is None:
+            batch_size = -(-len(batch) // n_workers)
+
+        # TensorFlow is not fork-safe, so workers start from a fresh interpreter
+        ctx = multiprocessing.get_context('spawn')
+        tasks = ctx.Queue()
+        results = ctx.Queue()
+
+        # Longest prompts first, so the most expensive chunks are picked up early
+        n_chunks = 0
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            tasks.put((rows, [batch[i] for i in rows]))
+            n_chunks += 1
+
+        workers = []
+        for cpus in _cpu_groups(n_workers):
+            tasks.put(None)
+            client_args = dict(model_name=self.model_name, save_dir=self.save_dir, dtype=self.dtype,
+                               use_xla=self.use_xla, num_intra=len(cpus), num_inter=self.num_inter)
+            worker = ctx.Process(target=_batch_worker, args=(
+                client_args, cpus, words, tasks, results))
+            worker.start()
+            workers.append(worker)
+
+        final_generated_text = [None] * len(batch)
+        while n_chunks > 0:
+            try:
+                rows, texts = results.get(timeout=1)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers) and results.empty():
+                    raise RuntimeError(
+                        'All sampling workers exited before the batch was finished.')
+                continue
+
+            for i, text in zip(rows, texts):
+                final_generated_text[i] = text
+            n_chunks -= 1
+
+        for worker in workers:
+            worker.join()
 
         return final_generated_text
 
@@ -303,87 +396,201 @@ class GPT2Client(object):
             gpt2.generate(sess)
 
     def encode_seq(self, sequence):
-        models_dir = models_dir = os.path.expanduser(
-            os.path.expandvars(self.save_dir))
+        # Only the encoder is needed, the sampling graph and weights are never loaded
         enc = get_encoder(self.model_name, self.save_dir)
-        hparams = default_hparams()
 
-        with open(os.path.join(self.save_dir, self.model_name, 'hparams.json')) as f:
-            data = json.load(f)
-            hparams.override_from_dict(data)
+        return np.asarray(enc.encode(sequence), dtype=np.int32)
 
-        length = hparams.n_ctx
+    def decode_seq(self, encodings):
+        # converting numpy array to list
+        if type(encodings).__module__ == np.__name__:
+            encodings = encodings.tolist()
 
-        with tf.Session(graph=tf.Graph()) as sess:
-            batch_size = 1
-            temperature = 1
-            top_k = 40
+        enc = get_encoder(self.model_name, self.save_dir)
 
-            context = tf.placeholder(tf.int32, [batch_size, None])
-            np.random.seed(None)
-            tf.set_random_seed(None)
+        sequences = enc.decode(encodings)
 
-            output = sample_sequence(
-                hparams=hparams,
-                length=length,
-                start_token=enc.encoder['<|endoftext|>'],
-                batch_size=batch_size,
-                temperature=temperature,
-                top_k=top_k
-            )
+        return sequences
 
-            saver = tf.train.Saver()
-            ckpt = tf.train.latest_checkpoint(
-                os.path.join(self.save_dir, self.model_name))
-            saver.restore(sess, ckpt)
+    def close(self):
+        """ Closes the cached TensorFlow session and download connections and releases the model weights
 
-            context_tokens = enc.encode(sequence)
-            content_tokens = np.array(content_tokens)
+        The graph is rebuilt and the checkpoint restored on the next call that needs it.
+        """
+        with self._session_lock:
+            if self._sess is not None:
+                self._sess.close()
+            if self._decode_pool is not None:
+                self._decode_pool.shutdown()
+            if self._http is not None:
+                self._http.close()
+
+            self._http = None
+            self._sess = None
+            self._decode_pool = None
+            self._iterator = None
+            self._batch_size_ph = None
+            self._length_ph = None
+            self._output = None
+
+    def _sample(self, contexts, words, batch_size):
+        """ Yields the tokens sampled after each context, as one array per run of `batch_size` rows
+
+        The input iterator is shared by the whole client, so the caller must hold `_session_lock`
+        from the first run until the generator is exhausted. The lock is not taken here, since a
+        generator abandoned mid-way would keep it held for as long as its frame stays alive.
+        """
+        self._pending_contexts = contexts
+        self._sess.run(self._iterator.initializer, feed_dict={
+            self._batch_size_ph: batch_size
+        })
 
-            return context_tokens
+        for start in range(0, len(contexts), batch_size):
+            width = max(len(tokens)
+                        for tokens in contexts[start:start + batch_size])
+            yield self._sess.run(self._output, feed_dict={
+                self._length_ph: words
+            })[:, width:]
 
-    def decode_seq(self, encodings):
-        # converting numpy array to list
-        if type(encodings).__module__ == np.__name__:
-            encodings = encodings.tolist()
+    def _context_rows(self):
+        """ Feeds the contexts given to `_sample` into the input pipeline """
+        for tokens in self._pending_contexts:
+            # Reversed, so that padded_batch's right padding ends up on the left
+            yield tokens[::-1], len(tokens)
 
-        models_dir = models_dir = os.path.expanduser(
-            os.path.expandvars(self.save_dir))
-        enc = get_encoder(self.model_name, self.save_dir)
-        hparams = default_hparams()
+    def _load_hparams(self):
+        """ Reads the model's hyper-parameters from disk once and caches them on the client """
+        if self._hparams is None:
+            hparams = default_hparams()
 
-        with open(os.path.join(self.save_dir, self.model_name, 'hparams.json')) as f:
-            data = json.load(f)
-            hparams.override_from_dict(data)
+            with open(os.path.join(self.save_dir, self.model_name, 'hparams.json')) as f:
+                data = json.load(f)
+                hparams.override_from_dict(data)
 
-        length = hparams.n_ctx
+            self._hparams = hparams
 
-        with tf.Session(graph=tf.Graph()) as sess:
-            batch_size = 1
-            temperature = 1
-            top_k = 40
+        return self._hparams
 
-            context = tf.placeholder(tf.int32, [batch_size, None])
-            np.random.seed(None)
-            tf.set_random_seed(None)
+    def _ensure_session(self):
+        """ Builds the sampling graph and restores the checkpoint once, then reuses them across calls
 
-            output = sample_sequence(
-                hparams=hparams,
-                length=length,
-                start_token=enc.encoder['<|endoftext|>'],
-                batch_size=batch_size,
-                temperature=temperature,
-                top_k=top_k
-            )
+        The caller must hold `_session_lock`, so that `close` cannot tear the session down mid-use.
+        """
+        if self._sess is None:
+            self._build_session()
+
+    def _build_session(self):
+
+        enc = get_encoder(self.model_name, self.save_dir)
+        hparams = self._load_hparams()
 
+        graph = tf.Graph()
+        with graph.as_default():
+            temperature = 1
+            top_k = 40
+
+            end_token = enc.encoder['<|endoftext|>']
+            batch_size = tf.placeholder(tf.int64, [])
+            length = tf.placeholder(tf.int32, [])
+
+            # Contexts are streamed through tf.data rather than fed to every run, and each
+            # batch is left-padded with <|endoftext|> up to its longest context
+            dataset = tf.data.Dataset.from_generator(
+                self._context_rows,
+                output_types=(tf.int32, tf.int32),
+                output_shapes=(tf.TensorShape([None]), tf.TensorShape([])))
+            dataset = dataset.padded_batch(
+                batch_size,
+                padded_shapes=(tf.TensorShape([None]), tf.TensorShape([])),
+                padding_values=(tf.constant(end_token, dtype=tf.int32), tf.constant(0, dtype=tf.int32)))
+            dataset = dataset.map(lambda tokens, n_tokens: (
+                tf.reverse(tokens, axis=[1]), tf.shape(tokens)[1] - n_tokens))
+            dataset = dataset.prefetch(2)
+
+            iterator = dataset.make_initializable_iterator()
+            # `pad_lengths` is the number of left-padding tokens in each row of `context`
+            context, pad_lengths = iterator.get_next()
+
+            custom_getter = half_precision_getter if self.dtype == 'fp16' else None
+            with tf.variable_scope(tf.get_variable_scope(), custom_getter=custom_getter):
+                output = sample_sequence(
+                    hparams=hparams,
+                    length=length,
+                    context=context,
+                    pad_lengths=pad_lengths,
+                    temperature=temperature,
+                    top_k=top_k
+                )
+
+            # Copies the restored float32 weights into their float16 counterparts, if any
+            half_precision_casts = {half.name: tf.assign(half, tf.cast(var, half.dtype))
+                                    for var, half in tf.get_collection(HALF_PRECISION_WEIGHTS)}
+
+            config = tf.ConfigProto(
+                intra_op_parallelism_threads=self.num_intra,
+                inter_op_parallelism_threads=self.num_inter)
+            if self.use_xla:
+                config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+
+            sess = tf.Session(graph=graph, config=config)
             saver = tf.train.Saver()
             ckpt = tf.train.latest_checkpoint(
                 os.path.join(self.save_dir, self.model_name))
             saver.restore(sess, ckpt)
-
-            sequences = enc.decode(encodings)
-
-            return sequences
+            sess.run(list(half_precision_casts.values()))
+
+        self._decode_pool = ThreadPoolExecutor(max_workers=2)
+        self._iterator = iterator
+        self._batch_size_ph = batch_size
+        self._length_ph = length
+        self._output = output
+        # Set last, as `_ensure_session` takes a non-None session to mean everything above is ready
+        self._sess = sess
+
+
+def _usable_cpus():
+    """Return the CPUs this process may run on, honouring its affinity mask where the OS exposes one."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def _cpu_groups(n_groups):
+    """Split the CPUs this process may run on into at most `n_groups` sets, keeping NUMA nodes together."""
+    cpus = _usable_cpus()
+
+    nodes = []
+    for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist')):
+        node = set()
+        with open(path) as f:
+            for part in f.read().strip().split(','):
+                if part:
+                    first, _, last = part.partition('-')
+                    node.update(range(int(first), int(last or first) + 1))
+        node = [cpu for cpu in cpus if cpu in node]
+        if node:
+            nodes.append(node)
+
+    if len(nodes) >= n_groups:
+        groups = [[] for _ in range(n_groups)]
+        for i, node in enumerate(nodes):
+            groups[i % n_groups].extend(node)
+        return groups
+
+    # Fewer NUMA nodes than groups, split the CPUs into contiguous ranges instead
+    n_groups = min(n_groups, len(cpus))
+    return [cpus[i * len(cpus) // n_groups:(i + 1) * len(cpus) // n_groups] for i in range(n_groups)]
+
+
+def _batch_worker(client_args, cpus, words, tasks, results):
+    """Sample chunks of prompts from `tasks` on a client of its own, pinned to `cpus`."""
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+    client = GPT2Client(**client_args)
+    for rows, prompts in iter(tasks.get, None):
+        results.put((rows, client.generate_batch_from_prompts(prompts, words)))
+    client.close()
 
 
 @lru_cache()
@@ -410,91 +617,148 @@ def bytes_to_unicode():
     return dict(zip(bs, cs))
 
 
-def get_pairs(word):
-    """Return set of symbol pairs in a word.
-
-    Word is represented as tuple of symbols (symbols being variable-length strings).
-    """
-    pairs = set()
-    prev_char = word[0]
-    for char in word[1:]:
-        pairs.add((prev_char, char))
-        prev_char = char
-    return pairs
-
-
 class Encoder:
-    def __init__(self, encoder, bpe_merges, errors='replace'):
+    def __init__(self, encoder, bpe_merges, errors='replace', cache_size=65536, max_token_len_cache=100):
         self.encoder = encoder
         self.decoder = {v: k for k, v in self.encoder.items()}
         self.errors = errors  # how to handle errors in decoding
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
+        # Maps latin-1 decoded bytes to their unicode symbols in a single str.translate call
+        self._byte_encoder_table = str.maketrans(
+            {chr(b): c for b, c in self.byte_encoder.items()})
+        # And back, so decoding becomes a translate followed by a latin-1 encode
+        self._byte_decoder_table = str.maketrans(
+            {c: chr(b) for c, b in self.byte_decoder.items()})
         self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+
+        # Bounded LRU of bpe() results so memory stays flat on long-running workloads.
+        # Tokens longer than `max_token_len_cache` are rare and are not worth caching.
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.max_token_len_cache = max_token_len_cache
 
         # Should haved added re.IGNORECASE so BPE merges can happen for capitalized versions of contractions
         self.pat = re.compile(
             r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
 
-    def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token)
-        pairs = get_pairs(word)
+        self._native = self._build_native_encoder(bpe_merges)
 
-        if not pairs:
+    def _build_native_encoder(self, bpe_merges):
+        """ Returns a tiktoken (Rust) encoding for this encoder's vocabulary, or None if unavailable
+
+        tiktoken ranks merges by the id of the merged token rather than replaying the merge list,
+        so the two algorithms can disagree on arbitrary vocabularies even when they are laid out
+        as the 256 byte symbols followed by one token per merge. The layout check below only
+        rejects vocabularies tiktoken cannot represent at all. Equivalence with the reference BPE
+        holds empirically for the OpenAI GPT-2 vocabulary shared by all four models this client
+        downloads, which is the same assumption tiktoken's own gpt2 encoding makes.
+        """
+        if tiktoken is None or '<|endoftext|>' not in self.encoder:
+            return None
+
+        symbols = list(self.byte_encoder.values()) + \
+            [first + second for first, second in bpe_merges]
+        if len(self.encoder) != len(symbols) + 1 or \
+                any(self.encoder.get(symbol) != rank for rank, symbol in enumerate(symbols)):
+            return None
+
+        return tiktoken.Encoding(
+            name='gpt2_client',
+            pat_str=self.pat.pattern,
+            mergeable_ranks={bytes(self.byte_decoder[c] for c in symbol): rank
+                             for rank, symbol in enumerate(symbols)},
+            special_tokens={'<|endoftext|>': self.encoder['<|endoftext|>']},
+        )
+
+    def bpe(self, token):
+        # Encoders are shared between clients and threads (see `get_encoder`), so another thread
+        # may evict the entry between the lookup and the move
+        word = self.cache.get(token)
+        if word is not None:
+            try:
+                self.cache.move_to_end(token)
+            except KeyError:
+                pass
+            return word
+        if len(token) < 2:
             return token
 
-        while True:
-            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(
-                pair, float('inf')))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
+        # Symbols live in a doubly-linked list over their original positions, and candidate
+        # merges sit in a min-heap ordered by (rank, position). Stale heap entries are skipped
+        # lazily instead of rescanning the whole word after every merge.
+        ranks = self.bpe_ranks
+        symbols = list(token)
+        prev = list(range(-1, len(symbols) - 1))
+        nxt = list(range(1, len(symbols) + 1))
+        nxt[-1] = -1
+
+        heap = []
+        for i in range(len(symbols) - 1):
+            rank = ranks.get((symbols[i], symbols[i + 1]))
+            if rank is not None:
+                heap.append((rank, i))
+        heapq.heapify(heap)
+
+        while heap:
+            # Apply every occurrence of the lowest ranked pair, left to right, before any
+            # pair created by those merges is considered
+            rank = heap[0][0]
+            positions = []
+            while heap and heap[0][0] == rank:
+                positions.append(heapq.heappop(heap)[1])
+
+            for i in positions:
+                j = nxt[i]
+                if symbols[i] is None or j == -1 or ranks.get((symbols[i], symbols[j])) != rank:
+                    continue
+
+                symbols[i] += symbols[j]
+                symbols[j] = None
+                nxt[i] = nxt[j]
+                if nxt[j] != -1:
+                    prev[nxt[j]] = i
+
+                if prev[i] != -1:
+                    left = ranks.get((symbols[prev[i]], symbols[i]))
+                    if left is not None:
+                        heapq.heappush(heap, (left, prev[i]))
+                if nxt[i] != -1:
+                    right = ranks.get((symbols[i], symbols[nxt[i]]))
+                    if right is not None:
+                        heapq.heappush(heap, (right, i))
+
+        word = ' '.join(symbol for symbol in symbols if symbol is not None)
+        if len(token) <= self.max_token_len_cache:
+            self.cache[token] = word
+            if len(self.cache) > self.cache_size:
                 try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word)-1 and word[i+1] == second:
-                    new_word.append(first+second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = ' '.join(word)
-        self.cache[token] = word
+                    self.cache.popitem(last=False)
+                except KeyError:
+                    pass
         return word
 
     def encode(self, text):
+        if self._native is not None:
+            # Special tokens are encoded as plain text, like the Python implementation below
+            return self._native.encode_ordinary(text)
+
         bpe_tokens = []
-        for token in re.findall(self.pat, text):
-            token = ''.join(self.byte_encoder[b]
-                            for b in token.encode('utf-8'))
+        for match in self.pat.finditer(text):
+            token = match.group().encode('utf-8').decode('latin-1').translate(
+                self._byte_encoder_table)
             bpe_tokens.extend(self.encoder[bpe_token]
                               for bpe_token in self.bpe(token).split(' '))
         return bpe_tokens
 
     def decode(self, tokens):
         text = ''.join([self.decoder[token] for token in tokens])
-        text = bytearray([self.byte_decoder[c]
-                         for c in text]).decode('utf-8', errors=self.errors)
+        text = text.translate(self._byte_decoder_table).encode(
+            'latin-1').decode('utf-8', errors=self.errors)
         return text
 
 
+@lru_cache(maxsize=4)
 def get_encoder(model_name, models_dir):
     with open("./{}/{}/".format(models_dir, model_name) + 'encoder.json', 'r') as f:
         encoder = json.load(f)
@@ -513,22 +777,18 @@ def top_k_logits(logits, k):
         # no truncation
         return logits
 
-    def _top_k():
-        values, _ = tf.nn.top_k(logits, k=k)
-        min_values = values[:, -1, tf.newaxis]
-        return tf.where(
-            logits < min_values,
-            tf.ones_like(logits, dtype=logits.dtype) * -1e10,
-            logits,
-        )
-    return tf.cond(
-        tf.equal(k, 0),
-        lambda: logits,
-        lambda: _top_k(),
+    # k is a Python int, so the branch above is resolved at graph construction time
+    # and the sampling loop carries no tf.cond
+    values, _ = tf.nn.top_k(logits, k=k)
+    min_values = values[:, -1, tf.newaxis]
+    return tf.where(
+        logits < min_values,
+        tf.fill(tf.shape(logits), tf.constant(-1e10, dtype=logits.dtype)),
+        logits,
     )
 
 
-def sample_sequence(hparams, length, start_token=None, batch_size=None, context=None, temperature=1, top_k=0):
+def sample_sequence(hparams, length, start_token=None, batch_size=None, context=None, pad_lengths=None, temperature=1, top_k=0):
     if start_token is None:
         assert context is not None, 'Specify exactly one of start_token and context!'
     else:
@@ -536,8 +796,8 @@ def sample_sequence(hparams, length, start_token=None, batch_size=None, context=
         context = tf.fill([batch_size, 1], start_token)
 
     def step(hparams, tokens, past=None):
-        lm_output = model(hparams=hparams, X=tokens,
-                          past=past, reuse=tf.AUTO_REUSE)
+        lm_output = model(hparams=hparams, X=tokens, past=past,
+                          pad_lengths=pad_lengths, reuse=tf.AUTO_REUSE)
 
         logits = lm_output['logits'][:, :, :hparams.n_vocab]
         presents = lm_output['present']
@@ -548,22 +808,28 @@ def sample_sequence(hparams, length, start_token=None, batch_size=None, context=
         }
 
     with tf.name_scope('sample_sequence'):
-        def body(past, prev, output):
-            next_outputs = step(hparams, prev, past=past)
-            logits = next_outputs['logits'][:, -1, :] / \
-                tf.to_float(temperature)
+        def sample(logits):
+            logits = logits[:, -1, :] / tf.to_float(temperature)
             logits = top_k_logits(logits, k=top_k)
-            samples = tf.multinomial(
+            return tf.multinomial(
                 logits, num_samples=1, output_dtype=tf.int32)
+
+        # Prefill: run the whole context once to seed the key/value cache
+        context_outputs = step(hparams, context)
+        past = context_outputs['presents']
+        prev = sample(context_outputs['logits'])
+        output = tf.concat([context, prev], axis=1)
+
+        def body(past, prev, output):
+            # Decode: feed only the last sampled token and attend over the cached keys/values
+            next_outputs = step(hparams, prev, past=past)
+            samples = sample(next_outputs['logits'])
             return [
-                next_outputs['presents'] if past is None else tf.concat(
-                    [past, next_outputs['presents']], axis=-2),
+                tf.concat([past, next_outputs['presents']], axis=-2),
                 samples,
                 tf.concat([output, samples], axis=1)
             ]
 
-        past, prev, output = body(None, context, context)
-
         def cond(*args):
             return True
 
@@ -578,7 +844,7 @@ def sample_sequence(hparams, length, start_token=None, batch_size=None, context=
             shape_invariants=[
                 tf.TensorShape(past_shape(
                     hparams=hparams, batch_size=batch_size)),
-                tf.TensorShape([batch_size, None]),
+                tf.TensorShape([batch_size, 1]),
                 tf.TensorShape([batch_size, None]),
             ],
             back_prop=False,
@@ -601,6 +867,24 @@ def default_hparams():
     )
 
 
+# Collection of (float32 variable, float16 copy) pairs created by `half_precision_getter`
+HALF_PRECISION_WEIGHTS = 'half_precision_weights'
+
+
+def half_precision_getter(getter, name, *args, **kwargs):
+    """Hand out a float16 copy of every weight matrix, keeping the float32 variable for the checkpoint."""
+    var = getter(name, *args, **kwargs)
+    if var.shape.ndims < 2:
+        # Biases and layer norm parameters stay in float32
+        return var
+
+    kwargs.update(dtype=tf.float16, initializer=tf.zeros_initializer(), trainable=False,
+                  collections=[tf.GraphKeys.LOCAL_VARIABLES])
+    half = getter(name + '_fp16', *args, **kwargs)
+    tf.add_to_collection(HALF_PRECISION_WEIGHTS, (var, half))
+    return half
+
+
 def shape_list(x):
     """Deal with dynamic shape in tensorflow cleanly."""
     static = x.shape.as_list()
@@ -609,9 +893,8 @@ def shape_list(x):
 
 
 def softmax(x, axis=-1):
-    x = x - tf.reduce_max(x, axis=axis, keepdims=True)
-    ex = tf.exp(x)
-    return ex / tf.reduce_sum(ex, axis=axis, keepdims=True)
+    # Single fused kernel instead of separate max, exp, sum and divide passes
+    return tf.nn.softmax(x, axis=axis)
 
 
 def gelu(x):
@@ -651,8 +934,10 @@ def conv1d(x, scope, nf, w_init_stdev=0.02):
         w = tf.get_variable(
             'w', [1, nx, nf], initializer=tf.random_normal_initializer(stddev=w_init_stdev))
         b = tf.get_variable('b', [nf], initializer=tf.constant_initializer(0))
-        c = tf.reshape(tf.matmul(tf.reshape(
-            x, [-1, nx]), tf.reshape(w, [-1, nf]))+b, start+[nf])
+        # w may be a float16 copy, activations are kept in float32 outside of the matmul
+        c = tf.matmul(tf.cast(tf.reshape(x, [-1, nx]), w.dtype),
+                      tf.reshape(w, [-1, nf]))
+        c = tf.reshape(tf.cast(c, tf.float32)+b, start+[nf])
         return c
 
 
@@ -667,7 +952,20 @@ def attention_mask(nd, ns, dtype):
     return tf.cast(m, dtype)
 
 
-def attn(x, scope, n_state, past, hparams):
+def attention_bias(nd, ns, pad_lengths=None):
+    """Additive attention bias of shape [batch or 1, 1, nd, ns]: 0 where a query may attend to a key, -1e10 elsewhere.
+
+    Left padding, given as the number of padding tokens per row, is never attended to.
+    """
+    b = tf.reshape(attention_mask(nd, ns, dtype=tf.float32), [1, 1, nd, ns])
+    if pad_lengths is not None:
+        keep = tf.cast(tf.range(ns)[None, :] >=
+                       pad_lengths[:, None], dtype=tf.float32)
+        b = b * tf.reshape(keep, [-1, 1, 1, ns])
+    return (1 - b) * -1e10
+
+
+def attn(x, scope, n_state, past, hparams, bias=None):
     assert x.shape.ndims == 3    # Should be [batch, sequence, features]
     assert n_state % hparams.n_head == 0
     if past is not None:
@@ -684,16 +982,16 @@ def attn(x, scope, n_state, past, hparams):
 
     def mask_attn_weights(w):
         # w has shape [batch, heads, dst_sequence, src_sequence], where information flows from src to dst.
-        _, _, nd, ns = shape_list(w)
-        b = attention_mask(nd, ns, dtype=w.dtype)
-        b = tf.reshape(b, [1, 1, nd, ns])
-        w = w*b - tf.cast(1e10, w.dtype)*(1-b)
-        return w
+        if bias is None:
+            _, _, nd, ns = shape_list(w)
+            return w + attention_bias(nd, ns)
+        return w + bias
 
     def multihead_attn(q, k, v):
         # q, k, v have shape [batch, heads, sequence, features]
+        # Scaling q instead of w touches [sequence, features] values rather than [sequence, sequence]
+        q = q * tf.rsqrt(tf.cast(v.shape[-1].value, q.dtype))
         w = tf.matmul(q, k, transpose_b=True)
-        w = w * tf.rsqrt(tf.cast(v.shape[-1].value, w.dtype))
 
         w = mask_attn_weights(w)
         w = softmax(w)
@@ -722,11 +1020,11 @@ def mlp(x, scope, n_state, hparams):
         return h2
 
 
-def block(x, scope, past, hparams):
+def block(x, scope, past, hparams, bias=None):
     with tf.variable_scope(scope):
         nx = x.shape[-1].value
         a, present = attn(norm(x, 'ln_1'), 'attn', nx,
-                          past=past, hparams=hparams)
+                          past=past, hparams=hparams, bias=bias)
         x = x + a
         m = mlp(norm(x, 'ln_2'), 'mlp', nx*4, hparams=hparams)
         x = x + m
@@ -750,7 +1048,7 @@ def positions_for(tokens, past_length):
     return expand_tile(past_length + tf.range(nsteps), batch_size)
 
 
-def model(hparams, X, past=None, scope='model', reuse=False):
+def model(hparams, X, past=None, pad_lengths=None, scope='model', reuse=False):
     with tf.variable_scope(scope, reuse=reuse):
         results = {}
         batch, sequence = shape_list(X)
@@ -760,7 +1058,23 @@ def model(hparams, X, past=None, scope='model', reuse=False):
         wte = tf.get_variable('wte', [hparams.n_vocab, hparams.n_embd],
                               initializer=tf.random_normal_initializer(stddev=0.02))
         past_length = 0 if past is None else tf.shape(past)[-2]
-        h = tf.gather(wte, X) + tf.gather(wpe, positions_for(X, past_length))
+        if past is not None and X.shape[1].value == 1:
+            # Decoding a single token: its position is past_length, so slice or gather that one
+            # row directly instead of building a tiled position range for the batch
+            if pad_lengths is None:
+                h_pos = tf.slice(wpe, [past_length, 0], [1, hparams.n_embd])[None]
+            else:
+                h_pos = tf.gather(wpe, past_length - pad_lengths)[:, None, :]
+        else:
+            positions = positions_for(X, past_length)
+            if pad_lengths is not None:
+                # Left-padded rows start counting positions at their first real token
+                positions = tf.maximum(positions - pad_lengths[:, None], 0)
+            h_pos = tf.gather(wpe, positions)
+        h = tf.cast(tf.gather(wte, X), tf.float32) + tf.cast(h_pos, tf.float32)
+
+        # The attention mask is the same for every layer, so it is built once
+        bias = attention_bias(sequence, past_length + sequence, pad_lengths)
 
         # Transformer
         presents = []
@@ -768,14 +1082,16 @@ def model(hparams, X, past=None, scope='model', reuse=False):
             None] * hparams.n_layer
         assert len(pasts) == hparams.n_layer
         for layer, past in enumerate(pasts):
-            h, present = block(h, 'h%d' % layer, past=past, hparams=hparams)
+            h, present = block(h, 'h%d' % layer, past=past,
+                               hparams=hparams, bias=bias)
             presents.append(present)
         results['present'] = tf.stack(presents, axis=1)
         h = norm(h, 'ln_f')
 
         # Language model loss. Do tokens <n predict token n?
         h_flat = tf.reshape(h, [batch*sequence, hparams.n_embd])
-        logits = tf.matmul(h_flat, wte, transpose_b=True)
+        logits = tf.matmul(tf.cast(h_flat, wte.dtype), wte, transpose_b=True)
+        logits = tf.cast(logits, tf.float32)
         logits = tf.reshape(logits, [batch, sequence, hparams.n_vocab])
         results['logits'] = logits
         return results
@@ -28,6 +28,9 @@ setup(
 			'termcolor',
 			'gpt_2_simple'
 		],
+	extras_require={
+			'fast': ['tiktoken']
+		},
 	classifiers=[
 		'Development Status :: 4 - Beta',
 		'Intended Audience :: Developers',